@@ -1,14 +1,176 @@
 import re, string, calendar
-from wikipedia import WikipediaPage
-import wikipedia
-from bs4 import BeautifulSoup
+import dbm, os, shelve, sqlite3, threading, time
+from functools import lru_cache
+from urllib.parse import quote
+import requests
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from nltk import word_tokenize, pos_tag, ne_chunk
 from nltk.tree import Tree
-from match import match
-from typing import List, Callable, Tuple, Any, Match
+from typing import List, Dict, Callable, Tuple, Any, Match, Optional, Pattern as RegexPattern
 
+# pages are fetched straight from the MediaWiki REST API, one request per page
+WIKI_REST_URL = "https://en.wikipedia.org/api/rest_v1/page/html/{}"
+WIKI_API_URL = "https://en.wikipedia.org/w/api.php"
+WIKI_TIMEOUT = 10
+
+# on-disk caches live next to this file rather than in the working directory
+CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# MediaWiki API responses are cached on disk across runs when requests_cache is
+# installed, only this session caches so importers keep a plain requests module.
+# If the cache database can't be created the session just doesn't cache
+try:
+    import requests_cache
+
+    SESSION = requests_cache.CachedSession(
+        os.path.join(CACHE_DIR, "wiki_cache"), backend="sqlite", expire_after=86400
+    )
+except (ImportError, OSError, sqlite3.Error):
+    SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "a10-wikipedia-chatbot (World Record database)"
+
+# page html persisted across runs under the in-process lru_cache. The shelf is only
+# opened on the first page lookup, so importing a10 doesn't touch the disk for it; if
+# it can't be opened pages just aren't persisted
+PAGE_SHELF_PATH = os.path.join(CACHE_DIR, "wiki_pages")
+PAGE_SHELF_EXPIRE = 86400
+_page_shelf_lock = threading.Lock()
+_page_shelf: Optional[shelve.Shelf] = None
+_page_shelf_failed = False
+
+# === Infobox field patterns, compiled once at import ===
+POLAR_RE = re.compile(
+    r"(?:Polar radius.*?)(?: ?[\d]+ )?(?P<radius>[\d,.]+)(?:.*?)km", re.DOTALL
+)
+BORN_RE = re.compile(r"(?:Born\D*)(?P<birth>\d{4}-\d{2}-\d{2})", re.DOTALL)
+# record values are matched against a single infobox row, see parse_infobox
+FASTEST_RE = re.compile(r"(?: ?[\d]+ )?(?P<fastest_time>[\d:.]+)(?:.*?)s", re.DOTALL)
+HIGHEST_RE = re.compile(
+    r"(?: ?[\d]+ )?(?P<highest_score>[\d,]+)(?:.*?)points", re.DOTALL
+)
+LONGEST_RE = re.compile(
+    r"(?: ?[\d]+ )?(?P<longest_distance>[\d,.]+)(?:.*?)km", re.DOTALL
+)
+
+# only build tree nodes for infobox elements, the rest of the page is discarded. The
+# strainer sees the raw class attribute, so match infobox as one class among several
+INFOBOX_STRAINER = SoupStrainer(attrs={"class": re.compile(r"(?:^|\s)infobox(?:\s|$)")})
+
+# runs of spaces or of newlines, keeping one of the repeated character in a group
+_COLLAPSE_RE = re.compile(r"( ) +|(\n)\n+")
+
+
+_PRINTABLE = frozenset(string.printable)
+# ascii characters outside string.printable, which clean_text also turns into spaces
+_CONTROL_RE = re.compile(r"[\x00-\x08\x0e-\x1f\x7f]")
+
+
+class _NonPrintableTable(dict):
+    """str.translate table mapping every non-printable codepoint to a space. Entries
+    are filled in the first time a codepoint is seen, so the table stays small"""
+
+    def __missing__(self, codepoint: int) -> Any:
+        value = codepoint if chr(codepoint) in _PRINTABLE else " "
+        self[codepoint] = value
+        return value
+
+
+_TRANSLATE = _NonPrintableTable()
+
+def page_url(title: str) -> str:
+    """Builds the REST API url for the html of a wikipedia page
+
+    Args:
+        title - title of the page
+
+    Returns:
+        url of the page html
+    """
+    return WIKI_REST_URL.format(quote(title.replace(" ", "_"), safe=""))
+
+def search_title(query: str) -> str:
+    """Finds the title of the closest matching wikipedia page
+
+    Args:
+        query - text to search for
+
+    Returns:
+        title of the best search result
+    """
+    params = {
+        "action": "query",
+        "list": "search",
+        "srsearch": query,
+        "srlimit": 1,
+        "format": "json",
+    }
+    response = SESSION.get(WIKI_API_URL, params=params, timeout=WIKI_TIMEOUT)
+    response.raise_for_status()
+    results = response.json()["query"]["search"]
+
+    if not results:
+        raise LookupError(f"No Wikipedia page found for {query}")
+    return results[0]["title"]
+
+def open_page_shelf() -> Optional[shelve.Shelf]:
+    """Opens the page shelf the first time it is needed, callers hold
+    _page_shelf_lock
+
+    Returns:
+        the open shelf, or None if it couldn't be opened
+    """
+    global _page_shelf, _page_shelf_failed
+
+    if _page_shelf is None and not _page_shelf_failed:
+        try:
+            _page_shelf = shelve.open(PAGE_SHELF_PATH)
+        except dbm.error:  # includes OSError
+            _page_shelf_failed = True
+    return _page_shelf
+
+def read_page_shelf(title: str) -> Optional[str]:
+    """Gets html of a wikipedia page from the shelf if it was stored recently
+
+    Args:
+        title - title of the page
+
+    Returns:
+        html of the page, or None if it isn't on the shelf or has expired
+    """
+    with _page_shelf_lock:
+        shelf = open_page_shelf()
+        if shelf is None:
+            return None
+        try:
+            entry = shelf.get(title)
+        except dbm.error:
+            return None
+
+    if entry is None or time.time() - entry[0] > PAGE_SHELF_EXPIRE:
+        return None
+    return entry[1]
+
+def write_page_shelf(title: str, html: str) -> None:
+    """Stores html of a wikipedia page on the shelf
+
+    Args:
+        title - title of the page
+        html - html of the page
+    """
+    with _page_shelf_lock:
+        shelf = open_page_shelf()
+        if shelf is None:
+            return
+        try:
+            shelf[title] = (time.time(), html)
+            shelf.sync()
+        except dbm.error:
+            pass
+
+@lru_cache(maxsize=128)
 def get_page_html(title: str) -> str:
-    """Gets html of a wikipedia page
+    """Gets html of a wikipedia page, from the page shelf if it has been fetched
+    recently
 
     Args:
         title - title of the page
@@ -16,25 +178,62 @@ def get_page_html(title: str) -> str:
     Returns:
         html of the page
     """
-    results = wikipedia.search(title)
-    return WikipediaPage(results[0]).html()
+    html = read_page_shelf(title)
+    if html is None:
+        html = fetch_page_html(title)
+        write_page_shelf(title, html)
+    return html
 
-def get_first_infobox_text(html: str) -> str:
-    """Gets first infobox html from a Wikipedia page (summary box)
+def fetch_page_html(title: str) -> str:
+    """Downloads html of a wikipedia page
+
+    Args:
+        title - title of the page
+
+    Returns:
+        html of the page
+    """
+    response = SESSION.get(page_url(title), timeout=WIKI_TIMEOUT)
+
+    if response.status_code in (400, 404):
+        # not an exact (or not even a valid, e.g. "c#") title, fall back to the extra
+        # search round-trip
+        response = SESSION.get(page_url(search_title(title)), timeout=WIKI_TIMEOUT)
+
+    response.raise_for_status()
+    return response.text
+
+@lru_cache(maxsize=64)
+def get_first_infobox(html: str) -> Tag:
+    """Parses the first infobox out of a Wikipedia page (summary box), shared by the
+    text and row based lookups so each page is only parsed once
 
     Args:
         html - the full html of the page
 
     Returns:
-        html of just the first infobox
+        tag of just the first infobox
     """
-    soup = BeautifulSoup(html, "html.parser")
-    results = soup.find_all(class_="infobox")
+    soup = BeautifulSoup(html, "lxml", parse_only=INFOBOX_STRAINER)
+    result = soup.find(class_="infobox")
 
-    if not results:
+    if result is None:
         raise LookupError("Page has no infobox")
-    return results[0].text
+    return result
+
+@lru_cache(maxsize=64)
+def get_first_infobox_text(html: str) -> str:
+    """Gets first infobox text from a Wikipedia page (summary box)
+
+    Args:
+        html - the full html of the page
+
+    Returns:
+        text of just the first infobox
+    """
+    return get_first_infobox(html).text
 
+@lru_cache(maxsize=64)
 def clean_text(text: str) -> str:
     """Cleans given text removing non-ASCII characters and duplicate spaces & newlines
 
@@ -44,29 +243,47 @@ def clean_text(text: str) -> str:
     Returns:
         cleaned text
     """
-    only_ascii = "".join([char if char in string.printable else " " for char in text])
-    no_dup_spaces = re.sub(" +", " ", only_ascii)
-    no_dup_newlines = re.sub("\n+", "\n", no_dup_spaces)
-    return no_dup_newlines
+    if (
+        text.isascii()
+        and "  " not in text
+        and "\n\n" not in text
+        and _CONTROL_RE.search(text) is None
+    ):
+        return text
+
+    only_ascii = text.translate(_TRANSLATE)
+    return _COLLAPSE_RE.sub(r"\1\2", only_ascii)
+
+
+@lru_cache(maxsize=64)
+def get_clean_infobox(title: str) -> str:
+    """Gets the cleaned text of the first infobox on a Wikipedia page
+
+    Args:
+        title - title of the page
+
+    Returns:
+        cleaned infobox text
+    """
+    return clean_text(get_first_infobox_text(get_page_html(title)))
 
 
 def get_match(
     text: str,
-    pattern: str,
+    pattern: RegexPattern[str],
     error_text: str = "Page doesn't appear to have the property you're expecting",
 ) -> Match:
-    """Finds regex matches for a pattern
+    """Finds regex matches for a precompiled pattern
 
     Args:
         text - text to search within
-        pattern - pattern to attempt to find within text
+        pattern - compiled pattern to attempt to find within text
         error_text - text to display if pattern fails to match
 
     Returns:
         text that matches
     """
-    p = re.compile(pattern, re.DOTALL)
-    match = p.search(text)
+    match = pattern.search(text)
 
     if not match:
         raise AttributeError(error_text)
@@ -82,10 +299,9 @@ def get_polar_radius(planet_name: str) -> str:
     Returns:
         radius of the given planet
     """
-    infobox_text = clean_text(get_first_infobox_text(get_page_html(planet_name)))
-    pattern = r"(?:Polar radius.*?)(?: ?[\d]+ )?(?P<radius>[\d,.]+)(?:.*?)km"
+    infobox_text = get_clean_infobox(planet_name)
     error_text = "Page infobox has no polar radius information"
-    match = get_match(infobox_text, pattern, error_text)
+    match = get_match(infobox_text, POLAR_RE, error_text)
 
     return match.group("radius")
 
@@ -99,58 +315,66 @@ def get_birth_date(name: str) -> str:
     Returns:
         birth date of the given person
     """
-    infobox_text = clean_text(get_first_infobox_text(get_page_html(name)))
-    pattern = r"(?:Born\D*)(?P<birth>\d{4}-\d{2}-\d{2})"
+    infobox_text = get_clean_infobox(name)
     error_text = (
         "Page infobox has no birth information (at least none in xxxx-xx-xx format)"
     )
-    match = get_match(infobox_text, pattern, error_text)
+    match = get_match(infobox_text, BORN_RE, error_text)
 
     return match.group("birth")
 
-def get_match(
-    text: str,
-    pattern: str,
-    error_text: str = "Page doesn't appear to have the property you're expecting",
-) -> Match:
-    """Finds regex matches for a pattern
+@lru_cache(maxsize=64)
+def parse_infobox(html: str) -> Dict[str, str]:
+    """Reads every labelled row of the first infobox in one pass over the tree
 
     Args:
-        text - text to search within
-        pattern - pattern to attempt to find within text
-        error_text - text to display if pattern fails to match
+        html - the full html of the page
 
     Returns:
-        text that matches
+        dictionary from lowercase row label to the text of the row's value, the
+        first row wins if a label repeats
     """
-    p = re.compile(pattern, re.DOTALL)
-    match = p.search(text)
+    rows: Dict[str, str] = {}
+    for tr in get_first_infobox(html).find_all("tr"):
+        th, td = tr.find("th"), tr.find("td")
+        if th is not None and td is not None:
+            # split/join also folds non-breaking spaces inside labels
+            label = " ".join(th.get_text(" ", strip=True).lower().split())
+            rows.setdefault(label, td.get_text(" ", strip=True))
+    return rows
+
+def get_infobox_row(name: str, label: str, error_text: str) -> str:
+    """Looks up the value of one infobox row for the given page
 
-    if not match:
+    Args:
+        name - title of the page
+        label - lowercase label of the row
+        error_text - text to display if the infobox doesn't have the row
+
+    Returns:
+        text of the row's value
+    """
+    rows = parse_infobox(get_page_html(name))
+
+    if label not in rows:
         raise AttributeError(error_text)
-    return match
+    return rows[label]
 
 def get_fastest_time(name: str) -> str:
-    infobox_text = clean_text(get_first_infobox_text(get_page_html(name)))
-    pattern = r"(?:Fastest time.*?)(?: ?[\d]+ )?(?P<fastest_time>[\d:.]+)(?:.*?)s"
     error_text = "Page infobox has no fastest time information"
-    match = get_match(infobox_text, pattern, error_text)
-    return match.group("fastest_time")
+    value = get_infobox_row(name, "fastest time", error_text)
+    return get_match(value, FASTEST_RE, error_text).group("fastest_time")
 
 def get_highest_score(name: str) -> str:
-    infobox_text = clean_text(get_first_infobox_text(get_page_html(name)))
-    pattern = r"(?:Highest score.*?)(?: ?[\d]+ )?(?P<highest_score>[\d,]+)(?:.*?)points"
     error_text = "Page infobox has no highest score information"
-    match = get_match(infobox_text, pattern, error_text)
-    return match.group("highest_score")
+    value = get_infobox_row(name, "highest score", error_text)
+    return get_match(value, HIGHEST_RE, error_text).group("highest_score")
 
 
 def get_longest_distance(name: str) -> str:
-    infobox_text = clean_text(get_first_infobox_text(get_page_html(name)))
-    pattern = r"(?:Longest distance.*?)(?: ?[\d]+ )?(?P<longest_distance>[\d,.]+)(?:.*?)km"
     error_text = "Page infobox has no longest distance information"
-    match = get_match(infobox_text, pattern, error_text)
-    return match.group("longest_distance")
+    value = get_infobox_row(name, "longest distance", error_text)
+    return get_match(value, LONGEST_RE, error_text).group("longest_distance")
 
 def fastest_time(matches: List[str]) -> List[str]:
     return [f"The fastest time in {matches[0]} is {get_fastest_time(matches[0])} seconds"]
@@ -169,34 +393,58 @@ Pattern = List[str]
 Action = Callable[[List[str]], List[Any]]
 
 pa_list: List[Tuple[Pattern, Action]] = [
-    ("what is the fastest time for %".split(), get_fastest_time),
-    ("who holds the record for the fastest time in %".split(), get_fastest_time),
-    ("what is the highest score in %".split(), get_highest_score),
-    ("who has the highest score in %".split(), get_highest_score),
-    ("what is the longest distance in %".split(), get_longest_distance),
-    ("who holds the record for the longest distance in %".split(), get_longest_distance),
+    ("what is the fastest time for %".split(), fastest_time),
+    ("who holds the record for the fastest time in %".split(), fastest_time),
+    ("what is the highest score in %".split(), highest_score),
+    ("who has the highest score in %".split(), highest_score),
+    ("what is the longest distance in %".split(), longest_distance),
+    ("who holds the record for the longest distance in %".split(), longest_distance),
     (["bye"], bye_action),
 ]
 
+# pa_list documents the supported phrasings, queries are actually dispatched with a
+# single alternation over all of them, routed on whichever named group matched
+# queries are lowercased and stripped of "?" once in query_loop, so the pattern is
+# case sensitive, and it is only ever used with fullmatch so the alternatives need
+# no anchors
+DISPATCH_RE = re.compile(
+    r"(?:what is the fastest time for|who holds the record for the fastest time in)"
+    r" (?P<fastest>.+)"
+    r"|(?:what is the highest score in|who has the highest score in)"
+    r" (?P<highest>.+)"
+    r"|(?:what is the longest distance in|who holds the record for the longest distance in)"
+    r" (?P<longest>.+)"
+    r"|(?P<bye>bye)"
+)
+
+DISPATCH_ACTIONS: Dict[str, Action] = {
+    "fastest": fastest_time,
+    "highest": highest_score,
+    "longest": longest_distance,
+    "bye": bye_action,
+}
+
 def search_pa_list(src: List[str]) -> List[str]:
-    """Takes source, finds matching pattern and calls corresponding action. If it finds
-    a match but has no answers it returns ["No answers"]. If it finds no match it
-    returns ["I don't understand"].
+    """Takes source, finds matching pattern in DISPATCH_RE and calls corresponding
+    action. If it finds a match but has no answers it returns ["No answers"]. If it
+    finds no match it returns ["I don't understand"].
 
     Args:
-        source - a phrase represented as a list of words (strings)
+        source - a phrase represented as a list of lowercase words (strings) with
+            "?" removed, as query_loop normalizes it
 
     Returns:
         a list of answers. Will be ["I don't understand"] if it finds no matches and
         ["No answers"] if it finds a match but no answers
     """
-    for pat, act in pa_list:
-        mat = match(pat, src)
-        if mat is not None:
-            answer = act(mat)
-            return answer if answer else ["No answers"]
+    dispatch = DISPATCH_RE.fullmatch(" ".join(src))
+    if dispatch is None:
+        return ["I don't understand"]
 
-    return ["I don't understand"]
+    act = DISPATCH_ACTIONS[dispatch.lastgroup]
+    mat = [] if act is bye_action else [dispatch.group(dispatch.lastgroup)]
+    answer = act(mat)
+    return answer if answer else ["No answers"]
 
 
 def query_loop() -> None:
@@ -216,4 +464,5 @@ def query_loop() -> None:
 
     print("\nSo long!\n")
 
-query_loop()
\ No newline at end of file
+if __name__ == "__main__":
+    query_loop()